@@ -23,6 +23,25 @@ def disable_dropout_in_model(model: torch.nn.Module) -> None:
     return model
 
 
+def mask_double_bos_tokens(input_ids: torch.Tensor, attention_mask: torch.Tensor, bos_token_id: int) -> None:
+    """Mask out the first of two leading BOS tokens in place (expects a left- or un-padded 2D batch)."""
+    # Find the start of each sequence (first non-pad token)
+    seq_starts = attention_mask.argmax(dim=1)
+
+    # Check for double BOS tokens
+    seq_second = torch.clamp(seq_starts + 1, max=input_ids.size(1) - 1)
+    double_bos_mask = (input_ids[torch.arange(input_ids.size(0)), seq_starts] == bos_token_id) & (
+        input_ids[torch.arange(input_ids.size(0)), seq_second] == bos_token_id
+    )
+
+    # Set attention mask to 0 for the first BOS token where double BOS is detected
+    if double_bos_mask.any():
+        attention_mask[
+            torch.arange(attention_mask.size(0), device=attention_mask.device)[double_bos_mask],
+            seq_starts[double_bos_mask],
+        ] = torch.tensor(0, device=attention_mask.device)
+
+
 class RewardBenchPipeline:
     def __init__(self, task, model, tokenizer):
         self.task = task
@@ -57,21 +76,7 @@ class RewardBenchPipeline:
                 input_ids = input_ids.unsqueeze(0)
                 attention_mask = attention_mask.unsqueeze(0)
 
-            # Find the start of each sequence (first non-pad token)
-            seq_starts = attention_mask.argmax(dim=1)
-
-            # Check for double BOS tokens
-            seq_second = torch.clamp(seq_starts + 1, max=input_ids.size(1) - 1)
-            double_bos_mask = (input_ids[torch.arange(input_ids.size(0)), seq_starts] == bos_token_id) & (
-                input_ids[torch.arange(input_ids.size(0)), seq_second] == bos_token_id
-            )
-
-            # Set attention mask to 0 for the first BOS token where double BOS is detected
-            if double_bos_mask.any():
-                attention_mask[
-                    torch.arange(attention_mask.size(0), device=attention_mask.device)[double_bos_mask],
-                    seq_starts[double_bos_mask],
-                ] = torch.tensor(0, device=attention_mask.device)
+            mask_double_bos_tokens(input_ids, attention_mask, bos_token_id)
 
         with torch.no_grad():
             outputs = self.model(**inputs)
@@ -114,21 +119,7 @@ class LowRankBenchPipeline:
                 input_ids = input_ids.unsqueeze(0)
                 attention_mask = attention_mask.unsqueeze(0)
 
-            # Find the start of each sequence (first non-pad token)
-            seq_starts = attention_mask.argmax(dim=1)
-
-            # Check for double BOS tokens
-            seq_second = torch.clamp(seq_starts + 1, max=input_ids.size(1) - 1)
-            double_bos_mask = (input_ids[torch.arange(input_ids.size(0)), seq_starts] == bos_token_id) & (
-                input_ids[torch.arange(input_ids.size(0)), seq_second] == bos_token_id
-            )
-
-            # Set attention mask to 0 for the first BOS token where double BOS is detected
-            if double_bos_mask.any():
-                attention_mask[
-                    torch.arange(attention_mask.size(0), device=attention_mask.device)[double_bos_mask],
-                    seq_starts[double_bos_mask],
-                ] = torch.tensor(0, device=attention_mask.device)
+            mask_double_bos_tokens(input_ids, attention_mask, bos_token_id)
 
         with torch.no_grad():
             outputs = self.model(return_dict=True, **inputs)
@@ -15,11 +15,13 @@
 # Run RewardBench (evaluate any reward model on any dataet)
 
 import argparse
+import functools
+import importlib.util
 import json
 import logging
 import os
 import sys
-from typing import Optional, Union
+from typing import NamedTuple, Optional, Union
 
 import numpy as np
 import torch
@@ -27,7 +29,8 @@ import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
 from tqdm import tqdm
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
 
 from rewardbench import (
     DPO_MODEL_CONFIG,
@@ -35,52 +38,170 @@ from rewardbench import (
     check_tokenizer_chat_template,
     load_preference_dataset,
 )
-from rewardbench.models.pipeline import LowRankBenchPipeline
+from rewardbench.models.pipeline import disable_dropout_in_model, mask_double_bos_tokens
 
 from transformers import LlamaForSequenceClassification
 
+class PreferenceOutput(NamedTuple):
+    logits_u: torch.FloatTensor
+    logits_v: torch.FloatTensor
+
+
 class LlamaForPreferencePrediction(LlamaForSequenceClassification):
     def __init__(self, config, num_pref_rank=1):
         self.num_pref_rank = num_pref_rank
         config.num_labels = 2 * self.num_pref_rank
         super().__init__(config)
-    
+
     def forward(
         self,
         input_ids: Optional[torch.LongTensor] = None,
         attention_mask: Optional[torch.Tensor] = None,
         position_ids: Optional[torch.LongTensor] = None,
-        past_key_values = None, # type: ignore
         inputs_embeds: Optional[torch.FloatTensor] = None,
-        labels: Optional[torch.LongTensor] = None,
-        use_cache: Optional[bool] = None,
-        output_attentions: Optional[bool] = None,
-        output_hidden_states: Optional[bool] = None,
+        # accepted only so callers passing return_dict (e.g. LowRankBenchPipeline) keep working,
+        # the output is always a PreferenceOutput
         return_dict: Optional[bool] = None,
     ):
-        seq_cls_outputs = super().forward(
+        # run the backbone directly and project only the pooled token, rather than scoring every position
+        # and building the full SequenceClassifierOutputWithPast in LlamaForSequenceClassification.forward
+        # single-shot scoring: never build a KV cache or keep per-layer hidden states / attentions around
+        transformer_outputs = self.model(
             input_ids,
             attention_mask=attention_mask,
             position_ids=position_ids,
-            past_key_values=past_key_values,
             inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=True,
+            use_cache=False,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=False,
         )
-        all_logits = seq_cls_outputs['logits']
-        logits_u = all_logits[:, :self.num_pref_rank]
-        logits_v = all_logits[:, self.num_pref_rank:]
+        # inputs are left-padded, so the last position is every row's final token; searching for the first
+        # pad token (as LlamaForSequenceClassification does) breaks when pad == EOS and EOS appears in the text
+        pooled_hidden_states = transformer_outputs[0][:, -1]
+
+        all_logits = self.score(pooled_hidden_states)
+        logits_u = all_logits[:, : self.num_pref_rank]
+        logits_v = all_logits[:, self.num_pref_rank :]
+
+        return PreferenceOutput(logits_u=logits_u, logits_v=logits_v)
 
-        if not return_dict:
-            output = (logits_u, logits_v) + seq_cls_outputs[1:]
-            return output
 
-        seq_cls_outputs['logits_u'] = logits_u
-        seq_cls_outputs['logits_v'] = logits_v
+def bucket_width(longest, min_width=128, max_width=None):
+    """Round a batch width up to the next power of two (at least `min_width`, at most `max_width` but never
+    below `longest`), so the number of distinct widths grows only logarithmically with the longest sequence."""
+    width = max(min_width, 1 << (longest - 1).bit_length())
+    if max_width is not None:
+        width = min(width, max_width)
+    return max(width, longest)
 
-        return seq_cls_outputs
+
+def collate_preference_pairs(examples, pad_token_id, bos_token_id=None, bucket_widths=False, max_width=None):
+    """Left-pad a batch of (chosen, rejected) token id tensors to the longest sequence in the batch.
+
+    With `bucket_widths`, the width is rounded up with `bucket_width` (capped at `max_width`),
+    so a compiled / graph-captured forward only sees a small set of sequence lengths.
+    """
+    # chosen and rejected are stacked so they are scored in a single forward pass of size 2 * batch_size
+    sequences = [chosen for chosen, _ in examples] + [rejected for _, rejected in examples]
+    # pad_sequence pads on the right, so pad the flipped sequences and flip the batch back
+    input_ids = torch.nn.utils.rnn.pad_sequence(
+        [seq.flip(0) for seq in sequences], batch_first=True, padding_value=pad_token_id
+    )
+    attention_mask = torch.nn.utils.rnn.pad_sequence(
+        [torch.ones_like(seq) for seq in sequences], batch_first=True, padding_value=0
+    )
+    longest = input_ids.shape[1]
+    if bucket_widths:
+        width = bucket_width(longest, max_width=max_width)
+        input_ids = torch.nn.functional.pad(input_ids, (0, width - longest), value=pad_token_id)
+        attention_mask = torch.nn.functional.pad(attention_mask, (0, width - longest), value=0)
+    input_ids, attention_mask = input_ids.flip(1), attention_mask.flip(1)
+    if bos_token_id is not None:
+        mask_double_bos_tokens(input_ids, attention_mask, bos_token_id)
+    return input_ids, attention_mask
+
+
+def restore_dataset_order(gathered, order):
+    """Undo the length sort on gathered per-pair outputs, dropping the duplicates added to even out batches."""
+    # processes get consecutive batches, so gathering step by step keeps sorted order, with the
+    # duplicated samples (taken from the start of the data) appended at the end
+    return gathered[: len(order)][torch.argsort(order)]
+
+
+def prefetch_to_device(dataloader, device):
+    """Yield batches on `device`, copying the next (pinned) batch on a side stream while the current one runs."""
+    if device.type != "cuda":
+        for batch in dataloader:
+            yield tuple(t.to(device) for t in batch)
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+    next_batch = None
+    for batch in dataloader:
+        with torch.cuda.stream(copy_stream):
+            batch = tuple(t.to(device, non_blocking=True) for t in batch)
+        if next_batch is not None:
+            yield next_batch
+        compute_stream = torch.cuda.current_stream(device)
+        compute_stream.wait_stream(copy_stream)
+        for t in batch:
+            t.record_stream(compute_stream)
+        next_batch = batch
+    if next_batch is not None:
+        yield next_batch
+
+
+def preference_margin(u_chosen, v_chosen, u_rejected, v_rejected):
+    # in float32 regardless of autocast, the sign of the margin decides the result
+    return (u_chosen.float() * v_rejected.float()).sum(-1) - (u_rejected.float() * v_chosen.float()).sum(-1)
+
+
+class CUDAGraphForward:
+    """Captures a CUDA graph of the model forward for each batch shape on first use and replays it afterwards."""
+
+    def __init__(self, model, num_warmup=3):
+        self.model = model
+        self.num_warmup = num_warmup
+        self.graphs = {}
+        # the graphs never run concurrently, so they can share one memory pool
+        self.pool = torch.cuda.graph_pool_handle()
+
+    def capture(self, input_ids, attention_mask):
+        static_input_ids = input_ids.clone()
+        static_attention_mask = attention_mask.clone()
+
+        # warm up on a side stream before capturing, as required by torch.cuda.graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup):
+                self.model(input_ids=static_input_ids, attention_mask=static_attention_mask)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # thread_local: the DataLoader pin-memory thread keeps allocating host memory during capture
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool, capture_error_mode="thread_local"):
+            static_outputs = self.model(input_ids=static_input_ids, attention_mask=static_attention_mask)
+        self.graphs[input_ids.shape] = (graph, static_input_ids, static_attention_mask, static_outputs)
+
+    def __call__(self, input_ids, attention_mask):
+        if input_ids.shape not in self.graphs:
+            self.capture(input_ids, attention_mask)
+        graph, static_input_ids, static_attention_mask, static_outputs = self.graphs[input_ids.shape]
+        static_input_ids.copy_(input_ids)
+        static_attention_mask.copy_(attention_mask)
+        graph.replay()
+        # outputs are overwritten by the next replay, callers consume them before scoring the next batch
+        return static_outputs
+
+
+def score_preference_batch(model, batch, margin_fn=preference_margin):
+    input_ids, attention_mask = batch
+    outputs = model(input_ids=input_ids.long(), attention_mask=attention_mask.long())
+    u_chosen, u_rejected = outputs.logits_u.chunk(2, dim=0)
+    v_chosen, v_rejected = outputs.logits_v.chunk(2, dim=0)
+    return margin_fn(u_chosen, v_chosen, u_rejected, v_rejected)
 
 
 def main():
@@ -104,6 +225,7 @@ def main():
     # inference args
     parser.add_argument("--batch_size", type=int, default=8, help="The batch size to use.")
     parser.add_argument("--max_length", type=int, default=512, help="The max length to use.")
+    parser.add_argument("--num_workers", type=int, default=2, help="DataLoader workers for batch collation.")
 
     # system args
     parser.add_argument("--load_json", action="store_true", default=False, help="Load dataset as json.")
@@ -114,13 +236,55 @@ def main():
     parser.add_argument(
         "--force_truncation", action="store_true", default=False, help="Force truncation (for if model errors)."
     )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        default=False,
+        help="Compile the model forward with torch.compile (mode=reduce-overhead).",
+    )
+    parser.add_argument(
+        "--cuda_graph",
+        action="store_true",
+        default=False,
+        help="Capture the model forward as a CUDA graph per batch shape (not with --torch_compile, whose "
+        "reduce-overhead mode already does this). Requires --attn_implementation eager.",
+    )
+    parser.add_argument(
+        "--torchao_quant_type",
+        type=str,
+        default=None,
+        choices=["int8_weight_only", "int4_weight_only"],
+        help="Quantize with torchao weight-only quantization instead of bitsandbytes LLM.int8() "
+        "(requires torchao and transformers>=4.45).",
+    )
+    parser.add_argument(
+        "--attn_implementation",
+        type=str,
+        default=None,
+        choices=["eager", "sdpa", "flash_attention_2"],
+        help="Attention implementation to use (default: flash_attention_2 if installed, else sdpa)",
+    )
     args = parser.parse_args()
+    if args.torchao_quant_type is not None and not (
+        hasattr(transformers, "TorchAoConfig") and importlib.util.find_spec("torchao") is not None
+    ):
+        parser.error("--torchao_quant_type requires torchao and transformers>=4.45 (TorchAoConfig)")
+    if args.cuda_graph and args.torch_compile:
+        parser.error("--cuda_graph cannot be combined with --torch_compile (reduce-overhead already uses CUDA graphs)")
+    if args.cuda_graph and args.attn_implementation != "eager":
+        # flash_attention_2 / sdpa synchronize with the host on padded batches, which breaks graph capture
+        parser.error("--cuda_graph requires --attn_implementation eager")
+
+    # allow TF32 for any remaining fp32 matmuls
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
 
     ###############
     # Setup logging
     ###############
     accelerator = Accelerator()
-    current_device = accelerator.process_index
+    # device index on this node (process_index is the global rank)
+    current_device = accelerator.local_process_index
 
     logger = get_logger(__name__)
     logging.basicConfig(
@@ -181,8 +345,14 @@ def main():
     ):
         quantized = False
         logger.info(f"Disabling quantization for llama-3 or override flag (--not_quantized: {args.not_quantized})")
+    if args.torchao_quant_type is not None and not quantized:
+        logger.warning(f"Ignoring --torchao_quant_type {args.torchao_quant_type}, the model is loaded unquantized")
+    if args.cuda_graph and quantized and args.torchao_quant_type is None:
+        # LLM.int8() outlier extraction synchronizes with the host, which breaks graph capture
+        parser.error(
+            "--cuda_graph does not work with bitsandbytes quantization, pass --not_quantized or --torchao_quant_type"
+        )
     custom_dialogue = config["custom_dialogue"]
-    pipeline_builder = LowRankBenchPipeline
     _ = config["model_type"]
     if custom_dialogue:
         raise NotImplementedError("Custom dialogue not implemented yet for simpler data formatting.")
@@ -208,7 +378,7 @@ def main():
             custom_dialogue_formatting=False,
             tokenizer=tokenizer,
             logger=logger,
-            keep_columns=["text_chosen", "text_rejected", "prompt"],
+            keep_columns=["text_chosen", "text_rejected"],
         )
     else:
         dataset = load_preference_dataset(
@@ -238,106 +408,193 @@ def main():
             truncation = True
             tokenizer.truncation_side = "left"
 
-        reward_pipeline_kwargs = {
-            "batch_size": args.batch_size,  # eval_args.inference_batch_size,
-            "truncation": truncation,
-            "padding": True,
-            "max_length": args.max_length,
-            "function_to_apply": "none",  # Compute raw logits
-            "return_token_type_ids": False,
-        }
-        if quantized:
+        # a compiled / graph-captured forward recompiles / recaptures per sequence length: round each batch up to
+        # a power of two (capped at max_length when truncating) to bound the number of shapes it sees
+        static_shapes = args.torch_compile or args.cuda_graph
+        max_width = args.max_length if truncation else None
+        if quantized and args.torchao_quant_type is not None:
+            # weight-only quantization keeps activations in bf16 and lowers to fused int mm kernels under
+            # torch.compile, unlike LLM.int8() (requires torchao and transformers>=4.45, checked above)
+            quant_kwargs = {"group_size": 128} if args.torchao_quant_type == "int4_weight_only" else {}
+            logger.info(f"Quantizing with torchao {args.torchao_quant_type}")
+            model_kwargs = {
+                "quantization_config": transformers.TorchAoConfig(args.torchao_quant_type, **quant_kwargs),
+                "device_map": {"": current_device},
+                "torch_dtype": torch.bfloat16,
+            }
+        elif quantized:
             model_kwargs = {
-                "load_in_8bit": True,
+                "quantization_config": BitsAndBytesConfig(load_in_8bit=True),
                 "device_map": {"": current_device},
                 "torch_dtype": torch.float16 if torch.cuda.is_available() else None,
             }
         else:
             # note, device map auto does not work for quantized models
-            model_kwargs = {"device_map": "auto"}
+            # with multiple processes each one holds a full replica and scores its own shard of the data
+            device_map = "auto" if accelerator.num_processes == 1 else {"": current_device}
+            model_kwargs = {"device_map": device_map, "torch_dtype": torch.bfloat16}
+
+        # default to fused attention kernels rather than Hugging Face's eager implementation
+        attn_implementation = args.attn_implementation
+        if attn_implementation is None:
+            attn_implementation = "flash_attention_2" if is_flash_attn_2_available() else "sdpa"
+        logger.info(f"Using attention implementation: {attn_implementation}")
+        model_kwargs["attn_implementation"] = attn_implementation
 
         model = model_builder(args.model, **model_kwargs, trust_remote_code=args.trust_remote_code)
-        reward_pipe = pipeline_builder(
-            "text-classification",  # often not used
-            model=model,
-            tokenizer=tokenizer,
-        )
+        if args.cuda_graph and len(set(getattr(model, "hf_device_map", {}).values())) > 1:
+            # a graph is captured on one device, a model split by device_map="auto" cannot be replayed from it
+            parser.error("--cuda_graph needs the model on a single GPU, restrict CUDA_VISIBLE_DEVICES to one device")
+        if args.torch_compile:
+            # batch widths are bucketed to powers of two, so avoid dynamic shapes and compile once per bucket
+            logger.info("Compiling model forward with torch.compile")
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", dynamic=False, fullgraph=False)
+            margin_fn = torch.compile(preference_margin, dynamic=True)
+        else:
+            margin_fn = preference_margin
+        model = disable_dropout_in_model(model).eval()
 
         # set pad token to eos token if not set
-        if reward_pipe.tokenizer.pad_token_id is None:
-            reward_pipe.model.config.pad_token_id = reward_pipe.tokenizer.eos_token_id
-            reward_pipe.tokenizer.pad_token_id = reward_pipe.tokenizer.eos_token_id
+        if tokenizer.pad_token_id is None:
+            model.config.pad_token_id = tokenizer.eos_token_id
+            tokenizer.pad_token_id = tokenizer.eos_token_id
         # For models whose config did not contains `pad_token_id`
-        if reward_pipe.model.config.pad_token_id is None:
-            reward_pipe.model.config.pad_token_id = reward_pipe.tokenizer.pad_token_id
+        if model.config.pad_token_id is None:
+            model.config.pad_token_id = tokenizer.pad_token_id
 
         # if using fastchat template (no template in tokenizer), make the RM tokenizer output an EOS token
         if not check_tokenizer_chat_template(tokenizer):
-            reward_pipe.tokenizer.add_eos_token = True
-
+            tokenizer.add_eos_token = True
+
+        # tokenize the whole dataset once, unpadded, instead of re-tokenizing strings every step;
+        # batches are left-padded to their own longest sequence in collate_preference_pairs
+        num_examples = len(dataset)
+        tokenized = tokenizer(
+            dataset["text_chosen"] + dataset["text_rejected"],
+            truncation=truncation,
+            max_length=args.max_length,
+        )
+        sequences = [torch.tensor(ids, dtype=torch.int32) for ids in tokenized["input_ids"]]
+        # only the token tensors are needed from here on, release the text columns
+        del dataset, tokenized
+        seq_lengths = torch.tensor([len(seq) for seq in sequences])
+        pair_lengths = torch.maximum(seq_lengths[:num_examples], seq_lengths[num_examples:])
+
+        # batch pairs of similar length together so per-batch padding stays small,
+        # results are put back in dataset order after inference
+        order = torch.argsort(pair_lengths, stable=True)
+        tokenized_dataset = [(sequences[i], sequences[num_examples + i]) for i in order.tolist()]
+        collate_fn = functools.partial(
+            collate_preference_pairs,
+            pad_token_id=tokenizer.pad_token_id,
+            bos_token_id=tokenizer.bos_token_id if tokenizer.bos_token else None,
+            bucket_widths=static_shapes,
+            max_width=max_width,
+        )
         dataloader = torch.utils.data.DataLoader(
-            dataset,
+            tokenized_dataset,
             batch_size=args.batch_size,
             shuffle=False,
             drop_last=False,
+            collate_fn=collate_fn,
+            pin_memory=True,
+            num_workers=args.num_workers,
+            persistent_workers=args.num_workers > 0,
         )
 
-        model = accelerator.prepare(reward_pipe.model)
-        reward_pipe.model = model
+        if static_shapes:
+            # the batch shapes the sorted data produces, mapped to the first batch of each; with more than
+            # one process every batch is topped up to batch_size (accelerate's even_batches)
+            sorted_lengths = pair_lengths[order]
+            batch_shapes = {}
+            for start in range(0, num_examples, args.batch_size):
+                end = min(start + args.batch_size, num_examples)
+                num_rows = end - start if accelerator.num_processes == 1 else args.batch_size
+                width = bucket_width(int(sorted_lengths[end - 1]), max_width=max_width)
+                batch_shapes.setdefault((num_rows, width), start)
+            logger.info(f"{len(batch_shapes)} batch shapes (pairs, width): {list(batch_shapes)}")
+            if args.torch_compile:
+                # one graph per shape, so dynamo does not give up and run the largest buckets eagerly
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(batch_shapes))
+
+        # evaluation_mode: no DDP wrapper (gradient buckets, parameter broadcast) around each inference replica
+        model = accelerator.prepare_model(model, evaluation_mode=True)
+        # shard batches across processes, batches stay on host so they are copied from pinned memory below
+        dataloader = accelerator.prepare_data_loader(dataloader, device_placement=False)
+
+    device = accelerator.device
 
     ############################
     # Run inference
     ############################
 
-    results = []
-    scores_margin = []
-    for step, batch in enumerate(tqdm(dataloader, desc="RM batch steps")):
-        logger.info(f"RM inference step {step}/{len(dataloader)}")
-
-
-        u_chosen, v_chosen = reward_pipe(batch["text_chosen"], **reward_pipeline_kwargs)
-        u_rejected, v_rejected = reward_pipe(batch["text_rejected"], **reward_pipeline_kwargs)
-        logits = torch.sum(u_chosen * v_rejected - u_rejected * v_chosen, dim=1)
-
-        # for each item in batch, record 1 if chosen > rejected
-        # extra score from dict within batched results (e.g. logits)
-        # [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
-        # score_chosen_batch = rewards_chosen.cpu().numpy().tolist()
-        # score_rejected_batch = rewards_rejected.cpu().numpy().tolist()
-        logits = logits.cpu().numpy().tolist()
-
-        # log results
-        [
-            results.append(1) if logit > 0 else results.append(0)
-            for logit in logits
-        ]
-        scores_margin.extend(logits)
+    # keep margins in a preallocated device buffer (sized for the padded, gathered batches) and copy them
+    # back once after the loop, avoiding a device sync every step
+    all_logits_gpu = torch.empty(len(dataloader) * args.batch_size * accelerator.num_processes, device=device)
+    num_scored = 0
+    # pure evaluation: skip autograd tracking, and autocast to bf16 when the weights are not quantized
+    # (the autocast weight cache must be disabled for CUDA graph capture)
+    autocast = torch.autocast("cuda", dtype=torch.bfloat16, enabled=not quantized, cache_enabled=not args.cuda_graph)
+    scoring_model = model
+    with torch.inference_mode(), autocast:
+        if args.cuda_graph:
+            scoring_model = CUDAGraphForward(accelerator.unwrap_model(model))
+        if static_shapes:
+            # run one batch of every shape up front, so compilation / graph capture is not mixed into the
+            # scored loop (a short batch is topped up from the start of the data, as accelerate does)
+            logger.info("*** Warming up compiled / graph-captured model on each batch shape ***")
+            for (num_rows, _), start in batch_shapes.items():
+                examples = tokenized_dataset[start : start + num_rows]
+                examples += tokenized_dataset[: num_rows - len(examples)]
+                warmup_batch = tuple(t.to(device) for t in collate_fn(examples))
+                score_preference_batch(scoring_model, warmup_batch, margin_fn)
+
+        batches = prefetch_to_device(dataloader, device)
+        for step, batch in enumerate(tqdm(batches, total=len(dataloader), desc="RM batch steps")):
+            logger.info(f"RM inference step {step}/{len(dataloader)}")
+
+            logits = score_preference_batch(scoring_model, batch, margin_fn)
+            # batches are padded to equal size across processes, the duplicates are dropped after the loop
+            # (gather_for_metrics relies on the end-of-dataloader flag, which the prefetching sets one batch early)
+            logits = accelerator.gather(logits.detach())
+            all_logits_gpu[num_scored : num_scored + logits.shape[0]] = logits
+            num_scored += logits.shape[0]
+
+    # for each item, record 1 if chosen > rejected
+    all_logits = restore_dataset_order(all_logits_gpu[:num_scored].cpu(), order)
+    scores_margin = all_logits.numpy()
+    results = (scores_margin > 0).astype(np.int8)
+
+    # every process holds the gathered results, only the main process reports and saves them
+    if not accelerator.is_main_process:
+        return
 
     ############################
     # compile scores
     ############################
     # calculate accuracy
-    accuracy = sum(results) / len(results)
-    logger.info(f"Results: {accuracy}, on {len(results)} prompts")
+    num_correct_total = int(results.sum())
+    num_prompts = len(results)
+    accuracy = num_correct_total / num_prompts
+    logger.info(f"Results: {accuracy}, on {num_prompts} prompts")
 
     # compute mean and std of scores, chosen and rejected, then margin between them
     # logger.info(f"Mean chosen: {np.mean(scores_chosen)}, std: {np.std(scores_chosen)}")
     # logger.info(f"Mean rejected: {np.mean(scores_rejected)}, std: {np.std(scores_rejected)}")
-    logger.info(f"Mean margin: {np.mean(np.array(scores_margin))}")
+    logger.info(f"Mean margin: {np.mean(scores_margin)}")
 
     if args.dataset == "allenai/reward-bench":
-        out_dataset = dataset.add_column("results", results)
         if args.debug:
             subsets = subsets[:10]
-        out_dataset = out_dataset.add_column("subsets", subsets)
-        out_dataset = out_dataset.to_pandas()  # I know this is meh
+
+        # per-subset counts in one vectorized pass, without materializing the dataset as a DataFrame
+        present_subsets, subset_codes = np.unique(np.asarray(subsets), return_inverse=True)
+        subset_correct = np.bincount(subset_codes, weights=results, minlength=len(present_subsets))
+        subset_total = np.bincount(subset_codes, minlength=len(present_subsets))
 
         results_grouped = {}
-        present_subsets = np.unique(out_dataset["subsets"])
-        for subset in present_subsets:
-            subset_dataset = out_dataset[out_dataset["subsets"] == subset]
-            num_correct = sum(subset_dataset["results"])
-            num_total = len(subset_dataset["results"])
+        for subset, num_correct, num_total in zip(present_subsets.tolist(), subset_correct, subset_total):
+            num_correct, num_total = int(num_correct), int(num_total)
             logger.info(f"{subset}: {num_correct}/{num_total} ({num_correct/num_total})")
             results_grouped[subset] = num_correct / num_total
 
@@ -360,7 +617,7 @@ def main():
         json.dump(
             {
                 "accuracy": accuracy,
-                "num_prompts": len(results),
+                "num_prompts": num_prompts,
                 "model": args.model,
                 "ref_model": args.ref_model,
                 "tokenizer": tokenizer_path,
@@ -382,9 +639,11 @@ def main():
         if os.path.exists(output_path):
             os.remove(output_path)
 
+        # write in chunks so only a slice of the margins is boxed as Python floats at a time
         with open(output_path, "w") as f:
-            for logit in scores_margin:
-                f.write(json.dumps({"reward_margin": logit}) + "\n")
+            for start in range(0, num_prompts, 4096):
+                chunk = scores_margin[start : start + 4096].tolist()
+                f.writelines(json.dumps({"reward_margin": logit}) + "\n" for logit in chunk)
 
 
 if __name__ == "__main__":
@@ -13,9 +13,9 @@
 # limitations under the License.
 
 import argparse
-import copy
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
 import yaml
@@ -47,8 +47,12 @@ assert not (args.eval_dpo_only and args.eval_rm_only), "Only one of eval_dpo_onl
 
 today = date.today().strftime("%m%d%Y")
 
+# use the C (libyaml) loader / dumper when available, configs are plain yaml so the safe variants suffice
+yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+yaml_dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
 with open("scripts/configs/beaker_eval.yaml", "r") as f:
-    d1 = yaml.load(f.read(), Loader=yaml.FullLoader)
+    d1 = yaml.load(f, Loader=yaml_loader)
 
 cluster = args.cluster
 
@@ -60,10 +64,10 @@ eval_on_bon = args.eval_on_bon
 
 if eval_on_bon:
     with open("scripts/configs/eval_bon_configs.yaml", "r") as f:
-        configs = yaml.load(f.read(), Loader=yaml.FullLoader)
+        configs = yaml.load(f, Loader=yaml_loader)
 else:
     with open("scripts/configs/eval_configs.yaml", "r") as f:
-        configs = yaml.load(f.read(), Loader=yaml.FullLoader)
+        configs = yaml.load(f, Loader=yaml_loader)
 print(configs)
 
 
@@ -84,6 +88,11 @@ if args.model is not None:
     else:
         raise ValueError(f"Model {args.model} not found in configs")
 
+# use os to check if beaker_configs/auto_created exists
+if not os.path.exists("beaker_configs/auto_created"):
+    os.makedirs("beaker_configs/auto_created")
+
+cmds = []
 for model in models_to_evaluate:
     model_config = configs[model]
     eval_dpo = model_config["dpo"]
@@ -128,7 +137,11 @@ for model in models_to_evaluate:
         experiment_group += "-pref-sets"
 
     print(f"Submitting evaluation for model: {model} on {experiment_group}")
-    d = copy.deepcopy(d1)
+    # only the first task is modified per model, so copy just the parts of it that change
+    task = dict(d1["tasks"][0])
+    task["resources"] = dict(task["resources"])
+    task["arguments"] = list(task["arguments"])
+    d = dict(d1, tasks=[task] + d1["tasks"][1:])
 
     name = f"rewardbench_eval_for_{model}_on_{experiment_group}".replace("/", "-")
     d["description"] = name
@@ -172,14 +185,14 @@ for model in models_to_evaluate:
     if "max_length" in model_config:  # for `mightbe/Better-PairRM`, but could come up in the future
         d["tasks"][0]["arguments"][0] += f" --max_length {model_config['max_length']}"
 
-    # use os to check if beaker_configs/auto_created exists
-    if not os.path.exists("beaker_configs/auto_created"):
-        os.makedirs("beaker_configs/auto_created")
-
     fn = "beaker_configs/auto_created/{}.yaml".format(name)
     file = open(fn, "w")
-    yaml.dump(d, file, default_flow_style=True)
+    yaml.dump(d, file, Dumper=yaml_dumper, default_flow_style=True)
     file.close()
 
-    cmd = "beaker experiment create {} --workspace ai2/rewardbench".format(fn)
-    subprocess.Popen(cmd, shell=True)
+    cmds.append("beaker experiment create {} --workspace ai2/rewardbench".format(fn))
+
+# submit experiments concurrently (bounded), surfacing any failed submission
+with ThreadPoolExecutor(max_workers=8) as executor:
+    for _ in executor.map(lambda cmd: subprocess.run(cmd, shell=True, check=True), cmds):
+        pass
@@ -0,0 +1,192 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# tests for the batching and scoring helpers in rewardbench_lrpo.py (CPU only)
+import unittest
+
+import torch
+from accelerate.data_loader import BatchSamplerShard
+from transformers import LlamaConfig, LlamaForSequenceClassification
+
+from rewardbench.models.pipeline import mask_double_bos_tokens
+from rewardbench_lrpo import (
+    LlamaForPreferencePrediction,
+    bucket_width,
+    collate_preference_pairs,
+    restore_dataset_order,
+)
+
+PAD, BOS, EOS = 0, 1, 2
+
+
+class MaskDoubleBosTest(unittest.TestCase):
+    def test_left_padded_batch(self):
+        input_ids = torch.tensor(
+            [
+                [PAD, PAD, BOS, BOS, 5],
+                [PAD, BOS, 5, 6, 7],
+                [BOS, BOS, 5, 6, 7],
+            ]
+        )
+        attention_mask = (input_ids != PAD).long()
+        mask_double_bos_tokens(input_ids, attention_mask, BOS)
+
+        expected = torch.tensor(
+            [
+                [0, 0, 0, 1, 1],
+                [0, 1, 1, 1, 1],
+                [0, 1, 1, 1, 1],
+            ]
+        )
+        self.assertTrue(torch.equal(attention_mask, expected))
+
+
+class CollatePreferencePairsTest(unittest.TestCase):
+    def setUp(self):
+        self.examples = [
+            (torch.tensor([BOS, BOS, 5], dtype=torch.int32), torch.tensor([BOS, 6], dtype=torch.int32)),
+            (torch.tensor([BOS, 7], dtype=torch.int32), torch.tensor([BOS, 8, 9, 10], dtype=torch.int32)),
+        ]
+
+    def test_left_pads_to_longest(self):
+        input_ids, attention_mask = collate_preference_pairs(self.examples, pad_token_id=PAD, bos_token_id=BOS)
+
+        # chosen first, then rejected
+        expected_ids = torch.tensor(
+            [
+                [PAD, BOS, BOS, 5],
+                [PAD, PAD, BOS, 7],
+                [PAD, PAD, BOS, 6],
+                [BOS, 8, 9, 10],
+            ],
+            dtype=torch.int32,
+        )
+        expected_mask = torch.tensor(
+            [
+                [0, 0, 1, 1],
+                [0, 0, 1, 1],
+                [0, 0, 1, 1],
+                [1, 1, 1, 1],
+            ],
+            dtype=torch.int32,
+        )
+        self.assertTrue(torch.equal(input_ids, expected_ids))
+        self.assertTrue(torch.equal(attention_mask, expected_mask))
+
+    def test_bucket_widths(self):
+        input_ids, attention_mask = collate_preference_pairs(self.examples, pad_token_id=PAD, bucket_widths=True)
+        self.assertEqual(input_ids.shape, (4, 128))
+        self.assertTrue(torch.equal(input_ids[3, -4:], torch.tensor([BOS, 8, 9, 10], dtype=torch.int32)))
+        self.assertEqual(int(attention_mask[:, :-4].sum()), 0)
+
+        # capped at max_width, but never below the longest sequence
+        input_ids, _ = collate_preference_pairs(self.examples, pad_token_id=PAD, bucket_widths=True, max_width=6)
+        self.assertEqual(input_ids.shape, (4, 6))
+        input_ids, _ = collate_preference_pairs(self.examples, pad_token_id=PAD, bucket_widths=True, max_width=2)
+        self.assertEqual(input_ids.shape, (4, 4))
+
+    def test_bucket_width(self):
+        self.assertEqual(bucket_width(1), 128)
+        self.assertEqual(bucket_width(128), 128)
+        self.assertEqual(bucket_width(129), 256)
+        self.assertEqual(bucket_width(3000), 4096)
+        self.assertEqual(bucket_width(3000, max_width=2048), 3000)
+        self.assertEqual(bucket_width(300, max_width=512), 512)
+
+
+class RestoreDatasetOrderTest(unittest.TestCase):
+    def test_round_trip(self):
+        pair_lengths = torch.tensor([5, 3, 9, 3, 1, 7, 2])
+        order = torch.argsort(pair_lengths, stable=True)
+        # score each sorted pair with its dataset index
+        margins = order.float()
+        self.assertTrue(torch.equal(restore_dataset_order(margins, order), torch.arange(7).float()))
+
+    def test_round_trip_with_even_batches(self):
+        num_examples, batch_size, num_processes = 11, 2, 2
+        pair_lengths = torch.randint(1, 100, (num_examples,))
+        order = torch.argsort(pair_lengths, stable=True)
+
+        # shard the sorted dataset the way accelerate does, padding so every process gets the same batches
+        batch_sampler = torch.utils.data.BatchSampler(range(num_examples), batch_size=batch_size, drop_last=False)
+        shards = [
+            BatchSamplerShard(batch_sampler, num_processes=num_processes, process_index=i, even_batches=True)
+            for i in range(num_processes)
+        ]
+        # gathering concatenates the processes' batches step by step
+        gathered = torch.cat([torch.tensor(batch) for step in zip(*shards) for batch in step])
+        self.assertGreater(len(gathered), num_examples)
+
+        margins = order[gathered].float()
+        restored = restore_dataset_order(margins, order)
+        self.assertTrue(torch.equal(restored, torch.arange(num_examples).float()))
+
+
+class LlamaForPreferencePredictionTest(unittest.TestCase):
+    def make_model(self, pad_token_id):
+        torch.manual_seed(0)
+        config = LlamaConfig(
+            vocab_size=32,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            num_key_value_heads=2,
+            pad_token_id=pad_token_id,
+        )
+        return LlamaForPreferencePrediction(config, num_pref_rank=2).eval()
+
+    def test_matches_sequence_classification_logits(self):
+        model = self.make_model(PAD)
+        reference = LlamaForSequenceClassification(model.config).eval()
+        reference.load_state_dict(model.state_dict())
+
+        input_ids = torch.tensor(
+            [
+                [PAD, PAD, BOS, 5, 6, 7],
+                [BOS, 8, 9, 10, 11, 12],
+                [PAD, PAD, PAD, PAD, BOS, 13],
+            ]
+        )
+        attention_mask = (input_ids != PAD).long()
+        with torch.no_grad():
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+            logits = reference(input_ids=input_ids, attention_mask=attention_mask).logits
+
+        self.assertEqual(outputs.logits_u.shape, (3, 2))
+        torch.testing.assert_close(outputs.logits_u, logits[:, :2])
+        torch.testing.assert_close(outputs.logits_v, logits[:, 2:])
+
+    def test_pools_last_token_when_pad_is_eos(self):
+        # no pad token in the tokenizer, so pad = EOS, and EOS also ends turns inside the text
+        model = self.make_model(EOS)
+        input_ids = torch.tensor(
+            [
+                [BOS, 5, EOS, 6, 7, EOS],
+                [EOS, EOS, BOS, 8, EOS, 9],
+            ]
+        )
+        attention_mask = torch.tensor(
+            [
+                [1, 1, 1, 1, 1, 1],
+                [0, 0, 1, 1, 1, 1],
+            ]
+        )
+        with torch.no_grad():
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+            hidden_states = model.model(input_ids, attention_mask=attention_mask)[0]
+            logits = model.score(hidden_states[:, -1])
+
+        torch.testing.assert_close(outputs.logits_u, logits[:, :2])
+        torch.testing.assert_close(outputs.logits_v, logits[:, 2:])